@@ -0,0 +1,300 @@
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
+import numpy as np
+from scipy import sparse
+from scipy.optimize import minimize
+from scipy.special import logsumexp, softmax
+from bayesian_testing.experiments import BinaryDataTest
+from .models import Experiment
+
+
+class ExperimentVotes:
+    """Columnar view of an experiment's choices for analysis.
+
+    Built straight from the raw Mongo document, without Pydantic validation.
+    Users, options and categories are interned into lookup lists, and each
+    vote is a row in two parallel int32 arrays (`vote_user`, `vote_option`).
+    Choices that reference an unknown option are dropped, and options whose
+    category is not one of the experiment's categories get category code -1.
+    """
+
+    __slots__ = (
+        "item_ids", "option_ids", "categories", "users",
+        "option_item", "option_category", "vote_user", "vote_option"
+    )
+
+    def __init__(
+        self,
+        item_ids: List[str],
+        option_ids: List[str],
+        categories: List[str],
+        users: List[str],
+        option_item: np.ndarray,
+        option_category: np.ndarray,
+        vote_user: np.ndarray,
+        vote_option: np.ndarray
+    ):
+        self.item_ids = item_ids
+        self.option_ids = option_ids
+        self.categories = categories
+        self.users = users
+        self.option_item = option_item
+        self.option_category = option_category
+        self.vote_user = vote_user
+        self.vote_option = vote_option
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "ExperimentVotes":
+        """Build the columns from a raw experiment document"""
+        categories = list(doc.get("categories", []))
+        category_codes = {cat: code for code, cat in enumerate(categories)}
+
+        item_ids = []
+        option_ids = []
+        option_item = []
+        option_category = []
+        user_codes: Dict[str, int] = {}
+        vote_user = []
+        vote_option = []
+
+        for item_code, item in enumerate(doc.get("items", [])):
+            item_ids.append(item["item_id"])
+            option_codes = {}
+            for option in item.get("options", []):
+                option_codes[option["id"]] = len(option_ids)
+                option_ids.append(option["id"])
+                option_item.append(item_code)
+                option_category.append(category_codes.get(option["category"], -1))
+            for choice in item.get("choices", []):
+                option_code = option_codes.get(choice["option_id"])
+                if option_code is None:
+                    continue
+                vote_user.append(user_codes.setdefault(choice["user_email"], len(user_codes)))
+                vote_option.append(option_code)
+
+        return cls(
+            item_ids=item_ids,
+            option_ids=option_ids,
+            categories=categories,
+            users=list(user_codes),
+            option_item=np.array(option_item, dtype=np.int32),
+            option_category=np.array(option_category, dtype=np.int32),
+            vote_user=np.array(vote_user, dtype=np.int32),
+            vote_option=np.array(vote_option, dtype=np.int32)
+        )
+
+    def __len__(self) -> int:
+        return len(self.vote_option)
+
+    @property
+    def vote_item(self) -> np.ndarray:
+        """Item code for each vote"""
+        return self.option_item[self.vote_option]
+
+    @property
+    def vote_category(self) -> np.ndarray:
+        """Category code for each vote (-1 for unknown categories)"""
+        return self.option_category[self.vote_option]
+
+    def option_counts(self) -> np.ndarray:
+        return np.bincount(self.vote_option, minlength=len(self.option_ids))
+
+    def item_counts(self) -> np.ndarray:
+        return np.bincount(self.vote_item, minlength=len(self.item_ids))
+
+    def category_counts(self, option_counts: Optional[np.ndarray] = None) -> np.ndarray:
+        if option_counts is None:
+            codes = self.vote_category
+            return np.bincount(codes[codes >= 0], minlength=len(self.categories))
+        known = self.option_category >= 0
+        counts = np.bincount(self.option_category[known], weights=option_counts[known], minlength=len(self.categories))
+        return counts.astype(np.int64)
+
+    def item_sizes(self) -> np.ndarray:
+        """Number of options on each item"""
+        return np.bincount(self.option_item, minlength=len(self.item_ids))
+
+    @property
+    def is_multi_arm(self) -> bool:
+        """True if this is more than a two-option A/B experiment"""
+        # Count the categories actually offered, not every declared one
+        used = np.unique(self.option_category[self.option_category >= 0]).size
+        if used < 2:
+            return False
+        return used > 2 or bool((self.item_sizes() > 2).any())
+
+    def choice_sets(self, option_counts: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Offered categories and vote counts per item, grouped by option count.
+
+        Each group is a pair of (n_items, k) arrays: the category code of every
+        option offered on an item, and the votes each option received. Options
+        with an unknown category are left out of the choice set, and items left
+        with fewer than two options are skipped. `option_counts` overrides the
+        votes per option, e.g. with counts kept up to date incrementally.
+        """
+        # Options are stored contiguously in item order, so each item is a run
+        option_index = np.flatnonzero(self.option_category >= 0)
+        sizes = np.bincount(self.option_item[option_index], minlength=len(self.item_ids))
+        starts = np.cumsum(sizes) - sizes
+        offered = self.option_category[option_index]
+        if option_counts is None:
+            option_counts = self.option_counts()
+        votes = option_counts[option_index]
+
+        groups = []
+        for size in np.unique(sizes):
+            if size < 2:
+                continue
+            index = starts[sizes == size][:, None] + np.arange(size)
+            groups.append((offered[index], votes[index]))
+        return groups
+
+    def votes_per_option(self) -> Dict[str, int]:
+        """Maps each option id to its number of votes"""
+        return dict(zip(self.option_ids, self.option_counts().tolist()))
+
+    def votes_per_item(self) -> Dict[str, int]:
+        """Maps each item id to its number of votes"""
+        return dict(zip(self.item_ids, self.item_counts().tolist()))
+
+    def votes_per_category(self, option_counts: Optional[np.ndarray] = None) -> Dict[str, int]:
+        """Maps each experiment category to its number of votes"""
+        return dict(zip(self.categories, self.category_counts(option_counts).tolist()))
+
+
+def binary_test_results(tally: ExperimentVotes, option_counts: Optional[np.ndarray] = None) -> List[Dict]:
+    """Per-category Bayesian binary test of "was chosen" over pooled vote totals"""
+    test = BinaryDataTest()
+    category_votes = tally.votes_per_category(option_counts)
+    total_votes = sum(category_votes.values())
+    for category in tally.categories:
+        test.add_variant_data_agg(
+            category,
+            totals=total_votes if total_votes > 0 else 1,  # Ensure we have at least 1 total
+            positives=category_votes[category]
+        )
+    return test.evaluate()
+
+
+def luce_choice_model(
+    choice_sets: List[Tuple[np.ndarray, np.ndarray]],
+    categories: List[str],
+    regularization: float = 0.01,
+    samples: int = 10000,
+    seed: Optional[int] = None
+) -> List[Dict]:
+    """Fit a Luce choice model to per-item choice sets.
+
+    Each category gets a log-strength `rating`, and a voter shown a set of
+    options picks one with probability softmax(rating) over the offered
+    categories. For two-option items this is exactly Bradley-Terry, and one
+    vote among k options counts as a single observation rather than k-1
+    pairwise wins. A small ridge penalty keeps the fit defined for categories
+    that are never or always chosen. The posterior is approximated as Gaussian
+    around the MAP estimate, which is also used to estimate each category's
+    probability of being the strongest.
+
+    Only categories offered on an item that received votes are rated. The
+    rest have no data behind them, so their rating, interval, win share and
+    probability of being best are None, and they are left out of the fit.
+    """
+    n = len(categories)
+    if n == 0:
+        return []
+
+    chosen = np.zeros(n)
+    offered_votes = np.zeros(n)
+    for offered, votes in choice_sets:
+        totals = votes.sum(axis=1, keepdims=True)
+        chosen += np.bincount(offered.ravel(), weights=votes.ravel(), minlength=n)
+        offered_votes += np.bincount(offered.ravel(), weights=np.broadcast_to(totals, votes.shape).ravel(), minlength=n)
+
+    # Renumber the rated categories 0..m-1 and keep only items with votes,
+    # which by construction offer rated categories only
+    rated = np.flatnonzero(offered_votes > 0)
+    m = len(rated)
+    codes = np.full(n, -1)
+    codes[rated] = np.arange(m)
+    rated_sets = []
+    for offered, votes in choice_sets:
+        voted = votes.sum(axis=1) > 0
+        if voted.any():
+            rated_sets.append((codes[offered[voted]], votes[voted]))
+
+    theta = std_error = win_share = prob_being_best = np.zeros(0)
+    if m > 0:
+        def objective(theta):
+            loss = 0.5 * regularization * np.dot(theta, theta)
+            grad = regularization * theta
+            for offered, votes in rated_sets:
+                utility = theta[offered]
+                log_p = utility - logsumexp(utility, axis=1, keepdims=True)
+                totals = votes.sum(axis=1, keepdims=True)
+                loss -= np.sum(votes * log_p)
+                grad -= np.bincount(offered.ravel(), weights=(votes - totals * np.exp(log_p)).ravel(), minlength=m)
+            return loss, grad
+
+        theta = minimize(objective, np.zeros(m), jac=True, method="L-BFGS-B").x
+        theta -= theta.mean()
+
+        # Observed information: each item adds N * (diag(p) - p p^T) over its offered categories
+        hessian = regularization * np.eye(m)
+        for offered, votes in rated_sets:
+            size = offered.shape[1]
+            p = softmax(theta[offered], axis=1)
+            totals = votes.sum(axis=1, keepdims=True)
+            block = totals[:, :, None] * p[:, :, None] * (np.eye(size) - p[:, None, :])
+            rows = np.broadcast_to(offered[:, :, None], block.shape)
+            cols = np.broadcast_to(offered[:, None, :], block.shape)
+            hessian += sparse.coo_matrix((block.ravel(), (rows.ravel(), cols.ravel())), shape=(m, m)).toarray()
+
+        # Ratings are only identified up to a shift, so report the covariance of
+        # the centered ratings rather than letting the ridge prior inflate it
+        centering = np.eye(m) - 1.0 / m
+        covariance = centering @ np.linalg.inv(hessian) @ centering
+        covariance = (covariance + covariance.T) / 2
+        std_error = np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+        rng = np.random.default_rng(seed)
+        draws = rng.multivariate_normal(theta, covariance, size=samples)
+        prob_being_best = np.bincount(draws.argmax(axis=1), minlength=m) / samples
+
+        strength = np.exp(theta)
+        win_share = strength / strength.sum()
+
+    results = []
+    for i, category in enumerate(categories):
+        result = {
+            "category": category,
+            "rating": None,
+            "std_error": None,
+            "credible_interval": None,
+            "win_share": None,
+            "chosen": int(chosen[i]),
+            "offered": int(offered_votes[i]),
+            "prob_being_best": None
+        }
+        j = codes[i]
+        if j >= 0:
+            result.update({
+                "rating": float(theta[j]),
+                "std_error": float(std_error[j]),
+                "credible_interval": (
+                    float(theta[j] - 1.96 * std_error[j]),
+                    float(theta[j] + 1.96 * std_error[j])
+                ),
+                "win_share": float(win_share[j]),
+                "prob_being_best": float(prob_being_best[j])
+            })
+        results.append(result)
+    return results
+
+
+async def fetch_raw_experiment(experiment_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Fetch an experiment document as a plain dict, skipping model validation"""
+    try:
+        object_id = ObjectId(experiment_id)
+    except (InvalidId, TypeError):
+        return None
+    return await Experiment.get_motor_collection().find_one({"_id": object_id}, projection)
@@ -0,0 +1,106 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from pymongo import ReturnDocument
+from .models import CacheVersion
+from .config import get_settings
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+settings = get_settings()
+
+# Admin users keyed by access_id
+admin_cache = TTLCache(maxsize=settings.cache_maxsize, ttl=settings.cache_ttl)
+# Experiment definitions (no choices) keyed by experiment id, and their
+# rendered markdown keyed by (experiment id, "rendered")
+experiment_cache = TTLCache(maxsize=settings.cache_maxsize, ttl=settings.cache_ttl)
+
+_CACHES = (admin_cache, experiment_cache)
+_VERSION_KEY = "global"
+
+_local_version: Optional[int] = None
+_last_poll = 0.0
+
+
+def _clear_all() -> None:
+    for cache in _CACHES:
+        cache.clear()
+
+
+async def sync_caches() -> None:
+    """Drop local entries if another worker has bumped the shared cache version.
+
+    The version document is polled at most once every `cache_poll_interval`
+    seconds. If Mongo is unavailable the caches keep working per-process and
+    rely on their TTL.
+    """
+    global _local_version, _last_poll
+    now = time.monotonic()
+    if now - _last_poll < settings.cache_poll_interval:
+        return
+    _last_poll = now
+    try:
+        doc = await CacheVersion.get_motor_collection().find_one({"_id": _VERSION_KEY})
+    except Exception as e:
+        logging.warning(f"Could not poll cache version: {str(e)}")
+        return
+    version = doc["version"] if doc else 0
+    if version != _local_version:
+        _clear_all()
+        _local_version = version
+
+
+async def invalidate(cache: TTLCache, key: Hashable) -> None:
+    """Invalidate `key` in this worker immediately and signal the other workers"""
+    global _local_version
+    cache.invalidate(key)
+    try:
+        doc = await CacheVersion.get_motor_collection().find_one_and_update(
+            {"_id": _VERSION_KEY},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except Exception as e:
+        logging.warning(f"Could not publish cache invalidation: {str(e)}")
+        return
+    # Everything else this worker holds is still valid, so skip the clear on next poll
+    if _local_version is not None and doc["version"] == _local_version + 1:
+        _local_version = doc["version"]
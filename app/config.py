@@ -8,6 +8,15 @@ class Settings(BaseSettings):
     database_name: str = "equential"
     users_collection: str = "users"
     base_url: str = "http://localhost:8000"
+    cache_ttl: float = 300.0
+    cache_maxsize: int = 1024
+    cache_poll_interval: float = 2.0
+    live_poll_interval: float = 5.0
+    live_update_interval: float = 1.0
+    live_posterior_interval: float = 10.0
+    job_concurrency: int = 2
+    job_poll_interval: float = 5.0
+    job_stale_after: float = 300.0
 
     model_config = SettingsConfigDict(
         env_file=find_dotenv(),
@@ -0,0 +1,217 @@
+import json
+import random
+import hashlib
+from itertools import chain, combinations
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+CHUNK_SIZE = 1 << 16
+
+
+class TemplateError(ValueError):
+    """The content template could not be applied to a record"""
+
+    def __init__(self, message: str, record_number: int):
+        super().__init__(message)
+        self.record_number = record_number
+
+
+class TemplateFieldError(TemplateError):
+    """A record is missing a field used by the content template"""
+
+    def __init__(self, field: str, record_number: int):
+        super().__init__(f"Record {record_number} has no field {field!r} used by the content template", record_number)
+        self.field = field
+
+
+def iter_records(f: IO[str]) -> Iterator[dict]:
+    """Stream records from a JSON array or an NDJSON file without loading it whole.
+
+    The array case is decoded one element at a time from a sliding buffer, so
+    memory is bounded by the largest single record rather than the file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while not buffer:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buffer = chunk.lstrip()
+    if not buffer.startswith("["):
+        # NDJSON: one record per line
+        for line in _iter_lines(buffer, f):
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+        yield record
+        buffer = buffer[end:]
+        if len(buffer) < CHUNK_SIZE:
+            buffer += f.read(CHUNK_SIZE)
+
+
+def _iter_lines(head: str, f: IO[str]) -> Iterator[str]:
+    pending = ""
+    for chunk in chain([head], iter(lambda: f.read(CHUNK_SIZE), "")):
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        yield from lines
+    yield pending
+
+
+def response_columns(record: dict, suffix: str) -> List[str]:
+    """Columns of a record holding model responses, e.g. `pinecone_response`"""
+    return sorted(key for key in record if key.endswith(suffix))
+
+
+def column_category(column: str, suffix: str) -> str:
+    """Category name for a response column, e.g. `pinecone_response` -> `pinecone`"""
+    return column[:-len(suffix)] if suffix and column.endswith(suffix) else column
+
+
+def pairwise_items(
+    records: Iterable[dict],
+    columns: List[str],
+    suffix: str,
+    content_template: str
+) -> Iterator[Tuple[Tuple[str, str], dict]]:
+    """Yield one upload-format item per record and pair of response columns.
+
+    Each item is tagged with its (category, category) pair so callers can
+    stratify on it. Categories come from `column_category`. Pairs
+    where either response is missing or empty are skipped. Raises
+    `TemplateFieldError` for a record (numbered from 1) that lacks a field the
+    template uses, and `TemplateError` for a malformed template or one whose
+    format spec or indexing doesn't fit the record.
+    """
+    for record_number, record in enumerate(records, 1):
+        try:
+            content = content_template.format_map(record)
+        except KeyError as e:
+            raise TemplateFieldError(e.args[0], record_number) from None
+        except (ValueError, IndexError, AttributeError, TypeError) as e:
+            raise TemplateError(f"Record {record_number}: invalid content template: {e}", record_number) from None
+        for column_a, column_b in combinations(columns, 2):
+            text_a, text_b = record.get(column_a), record.get(column_b)
+            if not text_a or not text_b:
+                continue
+            category_a = column_category(column_a, suffix)
+            category_b = column_category(column_b, suffix)
+            yield (category_a, category_b), {
+                "content": content,
+                "options": [
+                    {"text": text_a, "category": category_a},
+                    {"text": text_b, "category": category_b}
+                ]
+            }
+
+
+def content_hash(item: dict) -> bytes:
+    """Digest of an item's content and options, independent of option order"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(item["content"].encode())
+    for option in sorted(item["options"], key=lambda opt: (opt["category"], opt["text"])):
+        digest.update(b"\0" + option["category"].encode() + b"\0" + option["text"].encode())
+    return digest.digest()
+
+
+def dedupe(tagged_items: Iterable[Tuple[Tuple[str, str], dict]]) -> Iterator[Tuple[Tuple[str, str], dict]]:
+    """Drop items whose content hash has already been seen.
+
+    One 16-byte digest is kept per unique item, so memory grows linearly with
+    the number of unique items: about 80 bytes each in CPython, or roughly
+    80 MB per million items.
+    """
+    seen = set()
+    for stratum, item in tagged_items:
+        key = content_hash(item)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield stratum, item
+
+
+def stratified_sample(
+    tagged_items: Iterable[Tuple[Tuple[str, str], dict]],
+    target: int,
+    seed: Optional[int] = None
+) -> List[dict]:
+    """Sample up to `target` items spread evenly across category pairs.
+
+    Keeps a reservoir of `target` items per pair while streaming, so memory is
+    bounded by the sample size times the number of pairs. Pairs with too few
+    items give their unused share to the others.
+    """
+    rng = random.Random(seed)
+    reservoirs: Dict[Tuple[str, str], List[dict]] = {}
+    seen: Dict[Tuple[str, str], int] = {}
+    for stratum, item in tagged_items:
+        reservoir = reservoirs.setdefault(stratum, [])
+        seen[stratum] = seen.get(stratum, 0) + 1
+        if len(reservoir) < target:
+            reservoir.append(item)
+        else:
+            slot = rng.randrange(seen[stratum])
+            if slot < target:
+                reservoir[slot] = item
+
+    # Hand out the target round-robin so small strata don't waste their share
+    strata = sorted(reservoirs)
+    quotas = {stratum: 0 for stratum in strata}
+    remaining = target
+    while remaining > 0:
+        open_strata = [s for s in strata if quotas[s] < len(reservoirs[s])]
+        if not open_strata:
+            break
+        for stratum in open_strata[:remaining]:
+            quotas[stratum] += 1
+            remaining -= 1
+
+    sample = [item for stratum in strata for item in reservoirs[stratum][:quotas[stratum]]]
+    rng.shuffle(sample)
+    return sample
+
+
+def write_ndjson(
+    f: IO[str],
+    items: Iterable[dict],
+    name: str,
+    instructions: str,
+    category_descriptions: Dict[str, str]
+) -> int:
+    """Write an experiment as NDJSON: a header line, then one item per line"""
+    f.write(json.dumps({
+        "name": name,
+        "instructions": instructions,
+        "category_descriptions": category_descriptions
+    }) + "\n")
+    count = 0
+    for item in items:
+        f.write(json.dumps(item) + "\n")
+        count += 1
+    return count
+
+
+def parse_experiment_upload(raw: bytes) -> dict:
+    """Parse an uploaded experiment, either a single JSON document or NDJSON"""
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        lines = [line for line in raw.decode().splitlines() if line.strip()]
+        if len(lines) < 2:
+            raise
+        header = json.loads(lines[0])
+        header["items"] = [json.loads(line) for line in lines[1:]]
+        return header
@@ -0,0 +1,269 @@
+import asyncio
+import time
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
+from .analysis import ExperimentVotes, binary_test_results, luce_choice_model, fetch_raw_experiment
+from .models import Experiment, ChoiceChange
+from .config import get_settings
+
+Event = Tuple[str, dict]
+
+settings = get_settings()
+
+
+def _diff(new: Dict[str, int], old: Dict[str, int]) -> Dict[str, int]:
+    """Entries of `new` that differ from `old`"""
+    return {key: value for key, value in new.items() if old.get(key) != value}
+
+
+def _load_tally(doc: dict, option_votes: Dict[str, int], item_votes: Dict[str, int]) -> tuple:
+    """Build the tally for a freshly read document and diff it against what was last sent"""
+    tally = ExperimentVotes.from_document(doc)
+    new_option_votes = tally.votes_per_option()
+    new_item_votes = tally.votes_per_item()
+    delta = {
+        "option_votes": _diff(new_option_votes, option_votes),
+        "item_votes": _diff(new_item_votes, item_votes),
+        "total_responses": len(tally)
+    }
+    option_codes = {option_id: code for code, option_id in enumerate(tally.option_ids)}
+    return tally, tally.option_counts(), option_codes, new_option_votes, new_item_votes, delta
+
+
+def _compute_posteriors(tally: ExperimentVotes, option_counts: np.ndarray) -> dict:
+    return {
+        "binary": binary_test_results(tally, option_counts),
+        "choice": luce_choice_model(tally.choice_sets(option_counts), tally.categories) if tally.is_multi_arm else None
+    }
+
+
+class ExperimentFeed:
+    """Live results for one experiment, shared by every dashboard watching it.
+
+    Votes cast in this process arrive through `notify(change)` and are applied
+    to the tallies incrementally. Writes from other workers or background jobs
+    are only visible as a Mongo change stream event (or, without change
+    streams, the polling fallback), and trigger a full re-read of the
+    experiment at most every `live_poll_interval` seconds. A single background
+    task per experiment fans deltas out to each subscriber's queue. Posteriors
+    are recomputed at most every `live_posterior_interval` seconds, and all
+    CPU-heavy work runs in a thread so the event loop stays responsive.
+    """
+
+    def __init__(self, experiment_id: str):
+        self.experiment_id = experiment_id
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._streaming = False
+        self._pending: List[ChoiceChange] = []
+        self._reload_requested = False
+        self._reloaded_at = 0.0
+        self._tally: Optional[ExperimentVotes] = None
+        self._option_counts: Optional[np.ndarray] = None
+        self._option_codes: Dict[str, int] = {}
+        self._option_votes: Dict[str, int] = {}
+        self._item_votes: Dict[str, int] = {}
+        self._total_responses = 0
+        self._posteriors: Optional[dict] = None
+        self._posteriors_at = 0.0
+        self._posteriors_stale = False
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=100)
+        if self._posteriors is not None:
+            queue.put_nowait(("tally", self._snapshot()))
+            queue.put_nowait(("posteriors", self._posteriors))
+        self.subscribers.add(queue)
+        if self._task is None:
+            self._changed.set()
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            if self._task is not None:
+                self._task.cancel()
+            _feeds.pop(self.experiment_id, None)
+
+    def notify(self, change: Optional[ChoiceChange] = None) -> None:
+        """Mark the experiment as changed; the feed task picks it up.
+
+        With a `change` the tallies are updated in place. Without one the
+        change is unknown and the experiment is re-read.
+        """
+        if change is None:
+            self._reload_requested = True
+        else:
+            self._pending.append(change)
+        self._changed.set()
+
+    def _snapshot(self) -> dict:
+        return {
+            "option_votes": self._option_votes,
+            "item_votes": self._item_votes,
+            "total_responses": self._total_responses
+        }
+
+    def _broadcast(self, event: Event) -> None:
+        for queue in self.subscribers:
+            if queue.full():
+                # Slow consumer: drop its oldest event rather than block everyone
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _reload_due(self, now: float) -> bool:
+        if self._tally is None:
+            return True
+        if now - self._reloaded_at < settings.live_poll_interval:
+            return False
+        return self._reload_requested or not self._streaming
+
+    async def _run(self) -> None:
+        watcher = asyncio.create_task(self._watch_changes())
+        try:
+            while True:
+                now = time.monotonic()
+                deadlines = []
+                if self._reload_requested or not self._streaming:
+                    deadlines.append(self._reloaded_at + settings.live_poll_interval)
+                if self._posteriors_stale:
+                    deadlines.append(self._posteriors_at + settings.live_posterior_interval)
+                timeout = max(min(deadlines) - now, 0) if deadlines else None
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                # Coalesce bursts of votes into one update
+                await asyncio.sleep(settings.live_update_interval)
+                self._changed.clear()
+                try:
+                    if not await self._refresh():
+                        return
+                except Exception as e:
+                    logging.error(f"Failed to refresh live results for {self.experiment_id}: {str(e)}")
+        finally:
+            watcher.cancel()
+
+    async def _refresh(self) -> bool:
+        """Bring tallies up to date and broadcast changes. Returns False once the experiment is gone."""
+        if self._reload_due(time.monotonic()):
+            if not await self._reload():
+                return False
+        else:
+            self._apply_pending()
+
+        now = time.monotonic()
+        if self._posteriors is None or (
+            self._posteriors_stale and now - self._posteriors_at >= settings.live_posterior_interval
+        ):
+            self._posteriors = await asyncio.to_thread(
+                _compute_posteriors, self._tally, self._option_counts.copy()
+            )
+            self._posteriors_at = now
+            self._posteriors_stale = False
+            self._broadcast(("posteriors", self._posteriors))
+        return True
+
+    async def _reload(self) -> bool:
+        """Re-read the whole experiment and broadcast whatever changed"""
+        # Changes notified so far were written before this read, so it includes them
+        self._pending.clear()
+        self._reload_requested = False
+        doc = await fetch_raw_experiment(self.experiment_id)
+        self._reloaded_at = time.monotonic()
+        if not doc:
+            self._broadcast(("deleted", {}))
+            return False
+
+        tally, option_counts, option_codes, option_votes, item_votes, delta = await asyncio.to_thread(
+            _load_tally, doc, self._option_votes, self._item_votes
+        )
+        if self._pending:
+            # Votes that landed mid-read may or may not be in `doc`; re-read
+            # again later rather than risk counting them twice
+            self._pending.clear()
+            self._reload_requested = True
+        self._tally = tally
+        self._option_counts = option_counts
+        self._option_codes = option_codes
+        self._option_votes = option_votes
+        self._item_votes = item_votes
+        self._total_responses = delta["total_responses"]
+        if delta["option_votes"] or delta["item_votes"]:
+            self._broadcast(("tally", delta))
+            self._posteriors_stale = True
+        return True
+
+    def _apply_pending(self) -> None:
+        """Apply votes cast in this process to the tallies"""
+        option_delta: Dict[str, int] = {}
+        item_delta: Dict[str, int] = {}
+        for item_id, previous_option_id, option_id in self._pending:
+            code = self._option_codes.get(option_id)
+            if code is None:
+                # The experiment changed shape since the last read
+                self._reload_requested = True
+                continue
+            if previous_option_id == option_id:
+                continue
+            previous_code = self._option_codes.get(previous_option_id)
+            if previous_code is not None:
+                self._option_counts[previous_code] -= 1
+                self._option_votes[previous_option_id] -= 1
+                option_delta[previous_option_id] = self._option_votes[previous_option_id]
+            else:
+                # A first vote on this item (earlier votes for unknown options aren't counted)
+                self._item_votes[item_id] = self._item_votes.get(item_id, 0) + 1
+                item_delta[item_id] = self._item_votes[item_id]
+                self._total_responses += 1
+            self._option_counts[code] += 1
+            self._option_votes[option_id] += 1
+            option_delta[option_id] = self._option_votes[option_id]
+        self._pending.clear()
+        if option_delta:
+            self._broadcast(("tally", {
+                "option_votes": option_delta,
+                "item_votes": item_delta,
+                "total_responses": self._total_responses
+            }))
+            self._posteriors_stale = True
+
+    async def _watch_changes(self) -> None:
+        """Wake the feed on writes from any worker, if change streams are available"""
+        pipeline = [{"$match": {"documentKey._id": ObjectId(self.experiment_id)}}]
+        try:
+            async with Experiment.get_motor_collection().watch(pipeline) as stream:
+                self._streaming = True
+                async for _ in stream:
+                    self.notify()
+        except (PyMongoError, InvalidId) as e:
+            logging.info(f"Change streams unavailable, polling for live results: {str(e)}")
+        finally:
+            self._streaming = False
+
+
+_feeds: Dict[str, ExperimentFeed] = {}
+
+
+def get_feed(experiment_id: str) -> ExperimentFeed:
+    feed = _feeds.get(experiment_id)
+    if feed is None:
+        feed = _feeds[experiment_id] = ExperimentFeed(experiment_id)
+    return feed
+
+
+def notify_experiment_changed(experiment_id: str, change: Optional[ChoiceChange] = None) -> None:
+    """Wake the live feed for an experiment, if anyone is watching it.
+
+    Pass the `change` returned by `Experiment.record_choice` so the feed can
+    update incrementally; without it the feed re-reads the experiment.
+    """
+    feed = _feeds.get(experiment_id)
+    if feed is not None:
+        feed.notify(change)
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import uuid
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from .models import User, Experiment, Job
+from .analysis import ExperimentVotes, fetch_raw_experiment
+from .cache import admin_cache, experiment_cache, invalidate
+from .events import notify_experiment_changed
+from .config import get_settings
+
+settings = get_settings()
+
+BATCH_SIZE = 500
+
+Handler = Callable[..., Awaitable[Optional[Dict[str, Any]]]]
+_handlers: Dict[str, Handler] = {}
+
+
+def job_handler(kind: str):
+    """Register a coroutine as the handler for jobs of `kind`"""
+    def register(func: Handler) -> Handler:
+        _handlers[kind] = func
+        return func
+    return register
+
+
+class JobContext:
+    """Handed to a job handler so it can report progress"""
+
+    def __init__(self, job_id: ObjectId):
+        self.job_id = job_id
+
+    async def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None) -> None:
+        update = {"progress": done, "heartbeat_at": datetime.utcnow()}
+        if total is not None:
+            update["total"] = total
+        if message is not None:
+            update["message"] = message
+        await Job.get_motor_collection().update_one({"_id": self.job_id}, {"$set": update})
+
+
+class JobRunner:
+    """Runs queued jobs from the `jobs` collection with bounded concurrency.
+
+    Jobs are claimed atomically, so several workers can share the queue. A
+    running job's heartbeat is refreshed while it runs; jobs whose heartbeat
+    goes stale (e.g. the worker restarted) are put back in the queue.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._requeue_stale()
+                while True:
+                    await self._semaphore.acquire()
+                    try:
+                        job = await self._claim()
+                    except BaseException:
+                        self._semaphore.release()
+                        raise
+                    if job is None:
+                        self._semaphore.release()
+                        break
+                    task = asyncio.create_task(self._execute(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Job runner error: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.job_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _requeue_stale(self) -> None:
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.job_stale_after)
+        result = await Job.get_motor_collection().update_many(
+            {"status": "running", "heartbeat_at": {"$lt": cutoff}},
+            {"$set": {"status": "pending", "message": "Requeued after worker stopped responding"}}
+        )
+        if result.modified_count:
+            logging.warning(f"Requeued {result.modified_count} stale job(s)")
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await Job.get_motor_collection().find_one_and_update(
+            {"status": "pending"},
+            {"$set": {"status": "running", "started_at": now, "heartbeat_at": now}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _execute(self, job: dict) -> None:
+        jobs = Job.get_motor_collection()
+        heartbeat = asyncio.create_task(self._heartbeat(job["_id"]))
+        try:
+            handler = _handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            result = await handler(JobContext(job["_id"]), **job.get("params", {}))
+            await jobs.update_one({"_id": job["_id"]}, {"$set": {
+                "status": "completed",
+                "result": result or {},
+                "finished_at": datetime.utcnow()
+            }})
+        except asyncio.CancelledError:
+            # Shutting down: leave the job for the next worker to pick up
+            await jobs.update_one({"_id": job["_id"]}, {"$set": {"status": "pending"}})
+            raise
+        except Exception as e:
+            logging.error(f"Job {job['_id']} ({job['kind']}) failed: {str(e)}")
+            await jobs.update_one({"_id": job["_id"]}, {"$set": {
+                "status": "failed",
+                "error": str(e),
+                "finished_at": datetime.utcnow()
+            }})
+        finally:
+            heartbeat.cancel()
+            self._semaphore.release()
+            self.wake()
+
+    async def _heartbeat(self, job_id: ObjectId) -> None:
+        while True:
+            await asyncio.sleep(settings.job_stale_after / 3)
+            await Job.get_motor_collection().update_one(
+                {"_id": job_id}, {"$set": {"heartbeat_at": datetime.utcnow()}}
+            )
+
+
+job_runner = JobRunner(concurrency=settings.job_concurrency)
+
+
+async def enqueue_job(kind: str, **params) -> Job:
+    """Queue a job for the background runner and return it"""
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = Job(kind=kind, params=params)
+    await job.insert()
+    job_runner.wake()
+    return job
+
+
+def _gridfs() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(Job.get_motor_collection().database, bucket_name="exports")
+
+
+async def open_export(file_id: str):
+    """Open a finished export for streaming. Raises gridfs.errors.NoFile once it has been deleted."""
+    return await _gridfs().open_download_stream(ObjectId(file_id))
+
+
+async def _delete_exports(experiment_id: str, keep: Optional[ObjectId] = None) -> int:
+    """Delete an experiment's exports from GridFS, except the file `keep`"""
+    bucket = _gridfs()
+    query = {"metadata.experiment_id": experiment_id}
+    if keep is not None:
+        query["_id"] = {"$ne": keep}
+    file_ids = [grid_out._id async for grid_out in bucket.find(query)]
+    for file_id in file_ids:
+        try:
+            await bucket.delete(file_id)
+        except NoFile:
+            pass  # Already removed by a concurrent export
+    return len(file_ids)
+
+
+@job_handler("generate_links")
+async def generate_links(ctx: JobContext, experiment_id: str) -> Dict[str, Any]:
+    """Give every non-admin user an access link for an experiment"""
+    users = User.get_motor_collection()
+    query = {"is_admin": False, f"experiment_links.{experiment_id}": {"$exists": False}}
+    total = await users.count_documents(query)
+    await ctx.progress(0, total, "Generating access links")
+
+    done = 0
+    batch = []
+    async for user in users.find(query, {"_id": 1}):
+        batch.append(UpdateOne(
+            {"_id": user["_id"], f"experiment_links.{experiment_id}": {"$exists": False}},
+            {"$set": {f"experiment_links.{experiment_id}": str(uuid.uuid4())}}
+        ))
+        if len(batch) >= BATCH_SIZE:
+            await users.bulk_write(batch, ordered=False)
+            done += len(batch)
+            batch = []
+            await ctx.progress(done)
+    if batch:
+        await users.bulk_write(batch, ordered=False)
+        done += len(batch)
+    await ctx.progress(done, message="Done")
+    return {"links_created": done}
+
+
+@job_handler("delete_user")
+async def delete_user(ctx: JobContext, user_id: str) -> Dict[str, Any]:
+    """Delete a user along with every choice they made"""
+    user = await User.get(user_id)
+    if not user:
+        return {"deleted": False}
+
+    experiments = Experiment.get_motor_collection()
+    query = {"items.choices.user_email": user.email}
+    affected = [doc["_id"] async for doc in experiments.find(query, {"_id": 1})]
+    await ctx.progress(0, len(affected) + 1, "Removing votes")
+    for i, experiment_id in enumerate(affected):
+        await experiments.update_one(
+            {"_id": experiment_id},
+            {"$pull": {"items.$[].choices": {"user_email": user.email}}}
+        )
+        notify_experiment_changed(str(experiment_id))
+        await ctx.progress(i + 1)
+
+    await user.delete()
+    await invalidate(admin_cache, user.access_id)
+    await ctx.progress(len(affected) + 1, message="Done")
+    return {"deleted": True, "experiments_updated": len(affected)}
+
+
+@job_handler("delete_experiment")
+async def delete_experiment(ctx: JobContext, experiment_id: str) -> Dict[str, Any]:
+    """Delete an experiment and the access links pointing at it"""
+    await ctx.progress(0, 3, "Deleting experiment")
+    await Experiment.get_motor_collection().delete_one({"_id": ObjectId(experiment_id)})
+    await invalidate(experiment_cache, experiment_id)
+    await invalidate(experiment_cache, (experiment_id, "rendered"))
+    notify_experiment_changed(experiment_id)
+
+    await ctx.progress(1, message="Removing access links")
+    result = await User.get_motor_collection().update_many(
+        {f"experiment_links.{experiment_id}": {"$exists": True}},
+        {"$unset": {f"experiment_links.{experiment_id}": ""}}
+    )
+
+    await ctx.progress(2, message="Removing exports")
+    exports_removed = await _delete_exports(experiment_id)
+    await ctx.progress(3, message="Done")
+    return {"links_removed": result.modified_count, "exports_removed": exports_removed}
+
+
+@job_handler("purge_orphaned_votes")
+async def purge_orphaned_votes(ctx: JobContext, experiment_id: str) -> Dict[str, Any]:
+    """Drop votes from deleted users and votes for options that no longer exist"""
+    doc = await fetch_raw_experiment(experiment_id)
+    if not doc:
+        raise ValueError("Experiment not found")
+
+    emails = await User.get_motor_collection().distinct("email")
+    experiments = Experiment.get_motor_collection()
+    total_items = len(doc["items"])
+    await ctx.progress(0, total_items + 1, "Removing votes from deleted users")
+    before = len(ExperimentVotes.from_document(doc))
+    await experiments.update_one(
+        {"_id": doc["_id"]},
+        {"$pull": {"items.$[].choices": {"user_email": {"$nin": emails}}}}
+    )
+
+    await ctx.progress(1, message="Removing votes for unknown options")
+    for i in range(0, total_items, BATCH_SIZE):
+        await experiments.bulk_write([
+            UpdateOne(
+                {"_id": doc["_id"]},
+                {"$pull": {"items.$[item].choices": {"option_id": {"$nin": [opt["id"] for opt in item["options"]]}}}},
+                array_filters=[{"item.item_id": item["item_id"]}]
+            )
+            for item in doc["items"][i:i + BATCH_SIZE]
+        ], ordered=False)
+        await ctx.progress(min(i + BATCH_SIZE, total_items) + 1)
+
+    notify_experiment_changed(experiment_id)
+    after = len(ExperimentVotes.from_document(await fetch_raw_experiment(experiment_id)))
+    await ctx.progress(total_items + 1, message="Done")
+    return {"votes_before": before, "votes_after": after}
+
+
+@job_handler("export_votes")
+async def export_votes(ctx: JobContext, experiment_id: str) -> Dict[str, Any]:
+    """Write every vote of an experiment to an NDJSON file in GridFS.
+
+    Only the latest export of each experiment is kept; older ones are deleted
+    once the new file is complete.
+    """
+    doc = await fetch_raw_experiment(experiment_id)
+    if not doc:
+        raise ValueError("Experiment not found")
+    tally = ExperimentVotes.from_document(doc)
+    vote_item = tally.vote_item.tolist()
+    vote_category = tally.vote_category.tolist()
+    vote_option = tally.vote_option.tolist()
+    vote_user = tally.vote_user.tolist()
+    total = len(tally)
+    await ctx.progress(0, total, "Writing votes")
+
+    # ASCII only, so the name is safe in a Content-Disposition header
+    safe_name = "".join(c if c.isascii() and c.isalnum() or c in "-_" else "_" for c in doc["name"])
+    filename = f"{safe_name}-votes.ndjson"
+    stream = _gridfs().open_upload_stream(filename, metadata={"experiment_id": experiment_id})
+    for start in range(0, total, BATCH_SIZE):
+        lines = []
+        for row in range(start, min(start + BATCH_SIZE, total)):
+            category_code = vote_category[row]
+            lines.append(json.dumps({
+                "item_id": tally.item_ids[vote_item[row]],
+                "option_id": tally.option_ids[vote_option[row]],
+                "category": tally.categories[category_code] if category_code >= 0 else None,
+                "user_email": tally.users[vote_user[row]]
+            }) + "\n")
+        await stream.write("".join(lines).encode())
+        await ctx.progress(min(start + BATCH_SIZE, total))
+    await stream.close()
+    await _delete_exports(experiment_id, keep=stream._id)
+
+    await ctx.progress(total, message="Done")
+    return {"file_id": str(stream._id), "filename": filename, "votes": total}
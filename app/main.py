@@ -3,12 +3,21 @@ from fastapi import FastAPI, HTTPException, Request, Form, UploadFile, File
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from .database import init_db
-from .models import User, Experiment, Choice, ClassificationItem, Option
+from .models import User, Experiment, ExperimentDefinition, Job, Choice, ClassificationItem, Option
+from .analysis import ExperimentVotes, binary_test_results, luce_choice_model, fetch_raw_experiment
+from .cache import admin_cache, experiment_cache, sync_caches
+from .events import get_feed, notify_experiment_changed
+from .datasets import parse_experiment_upload
+from .jobs import job_runner, enqueue_job, open_export
 from pathlib import Path
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from typing import Optional, Union
+from bson import ObjectId
+from gridfs.errors import NoFile
+from urllib.parse import quote
+import asyncio
 import json
 import random
-from bayesian_testing.experiments import BinaryDataTest
 import pandas as pd
 import markdown2
 
@@ -22,6 +31,22 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 @app.on_event("startup")
 async def startup_event():
     await init_db()
+    job_runner.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_runner.stop()
+
+async def get_admin(access_id: str) -> User:
+    """Look up an admin by access_id, serving repeat requests from the cache"""
+    await sync_caches()
+    admin = admin_cache.get(access_id)
+    if admin is None:
+        admin = await User.find_one({"access_id": access_id})
+        if not admin or not admin.is_admin:
+            raise HTTPException(status_code=404, detail="Not found")
+        admin_cache.set(access_id, admin)
+    return admin
 
 @app.get("/user/{access_id}")
 async def get_user(access_id: str):
@@ -40,17 +65,19 @@ async def record_choice(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    experiment = await Experiment.get(experiment_id)
+    experiment = await get_experiment_definition(experiment_id)
     if not experiment:
         raise HTTPException(status_code=404, detail="Experiment not found")
     
-    success = await experiment.record_choice(
+    change = await Experiment.record_choice_by_id(
+        ObjectId(experiment.id),
         user_email=user.email,
         item_id=choice["item_id"],
-        chosen_option=choice["chosen_option"]
+        chosen_option_id=choice["chosen_option"]
     )
-    if not success:
+    if not change:
         raise HTTPException(status_code=400, detail="Invalid item_id or chosen_option")
+    notify_experiment_changed(experiment_id, change)
     
     return {"message": "Choice recorded successfully"}
 
@@ -93,9 +120,7 @@ async def get_unanswered_items(experiment_id: str, access_id: str):
 
 @app.get("/admin/{access_id}")
 async def admin_dashboard(request: Request, access_id: str):
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
     
     experiments = await Experiment.find_all().to_list()
     return templates.TemplateResponse(
@@ -108,14 +133,12 @@ async def create_experiment_admin(
     access_id: str,
     experiment_json: UploadFile = File(...)
 ):
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
 
     # Read and parse JSON
     try:
-        json_str = await experiment_json.read()
-        experiment_data = json.loads(json_str)
+        raw = await experiment_json.read()
+        experiment_data = parse_experiment_upload(raw)
         
         # Validate required fields
         required_fields = ["name", "instructions", "items", "category_descriptions"]
@@ -154,10 +177,8 @@ async def create_experiment_admin(
             category_descriptions=experiment_data["category_descriptions"]
         )
         
-        # Automatically generate links for all non-admin users
-        non_admin_users = await User.find({"is_admin": False}).to_list()
-        for user in non_admin_users:
-            await user.generate_experiment_link(str(experiment.id))
+        # Generate links for all non-admin users in the background
+        await enqueue_job("generate_links", experiment_id=str(experiment.id))
         
         return RedirectResponse(
             url=f"/admin/{access_id}", 
@@ -181,44 +202,61 @@ def render_markdown(text):
         'code-friendly'  # Better code handling
     ])
 
+async def get_experiment_definition(experiment_id: str) -> Optional[ExperimentDefinition]:
+    """An experiment without its choices, served from the cache after the first request.
+
+    Items, options and descriptions never change once an experiment is created,
+    so voting only needs the choices from Mongo, not the whole document.
+    """
+    await sync_caches()
+    definition = experiment_cache.get(experiment_id)
+    if definition is None:
+        doc = await fetch_raw_experiment(experiment_id, projection={"items.choices": 0})
+        if not doc:
+            return None
+        definition = ExperimentDefinition.from_document(doc)
+        experiment_cache.set(experiment_id, definition)
+    return definition
+
+async def get_rendered_definition(experiment: Union[Experiment, ExperimentDefinition]) -> dict:
+    """Rendered markdown for an experiment's instructions, items and options.
+
+    Content and option text never change once an experiment is created, so the
+    HTML is cached per experiment instead of being re-rendered on every request.
+    """
+    await sync_caches()
+    key = (str(experiment.id), "rendered")
+    definition = experiment_cache.get(key)
+    if definition is None:
+        definition = {
+            "user_instructions": render_markdown(experiment.user_instructions),
+            "items": {
+                item.item_id: {
+                    "content": render_markdown(item.content),
+                    "options": {option.id: render_markdown(option.text) for option in item.options}
+                }
+                for item in experiment.items
+            }
+        }
+        experiment_cache.set(key, definition)
+    return definition
+
 @app.get("/admin/{access_id}/experiments/{experiment_id}/results")
 async def admin_experiment_results(request: Request, access_id: str, experiment_id: str):
     # Verify admin access
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
     
-    experiment = await Experiment.get(experiment_id)
-    if not experiment:
+    doc = await fetch_raw_experiment(experiment_id)
+    if not doc:
         raise HTTPException(status_code=404, detail="Experiment not found")
+    experiment = ExperimentDefinition.from_document(doc)
+    tally = ExperimentVotes.from_document(doc)
     
-    # Get all non-admin users for progress calculation
-    users = await User.find({"is_admin": False}).to_list()
-    
-    # Prepare data for Bayesian testing
-    test = BinaryDataTest()
+    # Count non-admin users for progress calculation
+    total_users = await User.find({"is_admin": False}).count()
     
-    # Initialize counters for total votes per category
-    category_votes = {cat: 0 for cat in experiment.categories}
-    total_votes = 0
-    
-    # Count votes for each category across all items
-    for item in experiment.items:
-        votes_per_category = item.get_votes_per_category()
-        for category, votes in votes_per_category.items():
-            category_votes[category] += votes
-            total_votes += votes
-    
-    # Add aggregated data for each category
-    for category in experiment.categories:
-        test.add_variant_data_agg(
-            category,
-            totals=total_votes if total_votes > 0 else 1,  # Ensure we have at least 1 total
-            positives=category_votes[category]
-        )
-    
-    # Evaluate test and convert to DataFrame
-    results = test.evaluate()
+    # Evaluate Bayesian test and convert to DataFrame
+    results = binary_test_results(tally)
     results_df = pd.DataFrame(results).set_index('variant').T
     
     # Create a single bayesian result for all data
@@ -227,60 +265,93 @@ async def admin_experiment_results(request: Request, access_id: str, experiment_
         'results': results_df
     }]
     
-    # Pre-render markdown for items
+    # Items with more than two options, or more than two arms, also get a
+    # Luce choice model ranking over the categories offered on each item
+    choice_results = None
+    if tally.is_multi_arm:
+        choice_results = luce_choice_model(tally.choice_sets(), tally.categories)
+    
+    # Swap in pre-rendered markdown for items and instructions
+    definition = await get_rendered_definition(experiment)
     for item in experiment.items:
-        item.content = render_markdown(item.content)
+        rendered_item = definition["items"][item.item_id]
+        item.content = rendered_item["content"]
         for option in item.options:
-            option.text = render_markdown(option.text)
-    
-    # Pre-render experiment instructions
-    experiment.user_instructions = render_markdown(experiment.user_instructions)
+            option.text = rendered_item["options"][option.id]
+    experiment.user_instructions = definition["user_instructions"]
     
     return templates.TemplateResponse(
         "admin/results.html",
         {
             "request": request,
             "experiment": experiment,
-            "users": users,
+            "total_users": total_users,
+            "total_responses": len(tally),
+            "item_votes": tally.votes_per_item(),
+            "option_votes": tally.votes_per_option(),
             "access_id": access_id,
-            "bayesian_results": bayesian_results
+            "bayesian_results": bayesian_results,
+            "choice_results": choice_results
         }
     )
 
+@app.get("/admin/{access_id}/experiments/{experiment_id}/results/stream")
+async def stream_experiment_results(request: Request, access_id: str, experiment_id: str):
+    """Server-sent events with tally deltas and periodically recomputed posteriors"""
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    feed = get_feed(experiment_id)
+    queue = feed.subscribe()
+    
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event == "deleted":
+                    break
+        finally:
+            feed.unsubscribe(queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/admin/{access_id}/experiments/{experiment_id}/export")
 async def export_experiment_results(access_id: str, experiment_id: str):
     # Verify admin access
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
     
-    experiment = await Experiment.get(experiment_id)
-    if not experiment:
+    doc = await fetch_raw_experiment(experiment_id)
+    if not doc:
         raise HTTPException(status_code=404, detail="Experiment not found")
+    tally = ExperimentVotes.from_document(doc)
     
-    # Get all users who participated
-    users = await User.find({"is_admin": False}).to_list()
+    # Count users who can participate
+    total_users = await User.find({"is_admin": False}).count()
     
-    # Calculate overall stats per category
-    total_votes = sum(len(item.choices) for item in experiment.items)
-    votes_per_category = {cat: 0 for cat in experiment.categories}
-    
-    # Sum up votes per category across all items
-    for item in experiment.items:
-        item_votes = item.get_votes_per_category()
-        for category, votes in item_votes.items():
-            votes_per_category[category] += votes
+    # Calculate overall stats per category. Raw choices are counted, including
+    # any whose option no longer exists, so totals match the stored votes
+    total_votes = sum(len(item.get("choices", [])) for item in doc["items"])
+    votes_per_category = tally.votes_per_category()
     
     results = {
         "experiment": {
-            "id": str(experiment.id),
-            "name": experiment.name,
-            "instructions": experiment.user_instructions,
-            "categories": experiment.categories,
-            "total_items": len(experiment.items),
-            "total_users": len(users),
+            "id": str(doc["_id"]),
+            "name": doc["name"],
+            "instructions": doc["user_instructions"],
+            "categories": tally.categories,
+            "total_items": len(tally.item_ids),
+            "total_users": total_users,
             "total_votes": total_votes,
-            "total_possible_votes": len(experiment.items) * len(users),
+            "total_possible_votes": len(tally.item_ids) * total_users,
             "votes_per_category": votes_per_category,
             "percentages_per_category": {
                 cat: round((votes / total_votes * 100), 2) if total_votes > 0 else 0
@@ -288,6 +359,8 @@ async def export_experiment_results(access_id: str, experiment_id: str):
             }
         }
     }
+    if tally.is_multi_arm:
+        results["experiment"]["choice_results"] = luce_choice_model(tally.choice_sets(), tally.categories)
 
     return results
 
@@ -299,12 +372,13 @@ async def vote_interface(request: Request, access_id: str):
         raise HTTPException(status_code=404, detail="Not found")
     
     experiment_id = await user.get_experiment_for_link(access_id)
-    experiment = await Experiment.get(experiment_id)
+    experiment = await get_experiment_definition(experiment_id)
     if not experiment:
         raise HTTPException(status_code=404, detail="Experiment not found")
     
     # Get the next unanswered item
-    unanswered = experiment.get_unanswered_items(user.email)
+    answered = set(await Experiment.answered_item_ids(ObjectId(experiment.id), user.email))
+    unanswered = [item for item in experiment.items if item.item_id not in answered]
     if not unanswered:
         return templates.TemplateResponse(
             "vote/complete.html",
@@ -318,14 +392,16 @@ async def vote_interface(request: Request, access_id: str):
     shuffled_item = current_item.copy()
     shuffled_item.options = random.sample(current_item.options, len(current_item.options))
     
-    # Pre-render markdown
-    rendered_instructions = render_markdown(experiment.user_instructions)
-    rendered_content = render_markdown(shuffled_item.content)
+    # Look up pre-rendered markdown
+    definition = await get_rendered_definition(experiment)
+    rendered_item = definition["items"][shuffled_item.item_id]
+    rendered_instructions = definition["user_instructions"]
+    rendered_content = rendered_item["content"]
     rendered_options = []
     for option in shuffled_item.options:
         rendered_options.append({
             "id": option.id,
-            "text": render_markdown(option.text),
+            "text": rendered_item["options"][option.id],
             "category": option.category
         })
     shuffled_item.options = rendered_options
@@ -359,11 +435,13 @@ async def submit_vote(
         raise HTTPException(status_code=404, detail="Not found")
     
     experiment_id = await user.get_experiment_for_link(access_id)
-    experiment = await Experiment.get(experiment_id)
+    experiment = await get_experiment_definition(experiment_id)
     if not experiment:
         raise HTTPException(status_code=404, detail="Experiment not found")
     
-    await experiment.record_choice(user.email, item_id, choice)
+    change = await Experiment.record_choice_by_id(ObjectId(experiment.id), user.email, item_id, choice)
+    if change:
+        notify_experiment_changed(experiment_id, change)
     
     # Redirect back to the voting interface
     return RedirectResponse(
@@ -373,9 +451,7 @@ async def submit_vote(
 
 @app.get("/admin/{access_id}/users")
 async def admin_users(request: Request, access_id: str):
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
     
     users = await User.find({"is_admin": False}).to_list()
     
@@ -395,9 +471,7 @@ async def admin_create_user(
     email: str = Form(...),
     full_name: str = Form(...)
 ):
-    admin = await User.find_one({"access_id": access_id})
-    if not admin or not admin.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    admin = await get_admin(access_id)
     
     # Create the new user
     user = await User.create_user(email=email, full_name=full_name)
@@ -414,15 +488,14 @@ async def admin_create_user(
 
 @app.post("/admin/{access_id}/users/{user_id}/delete")
 async def admin_delete_user(access_id: str, user_id: str):
-    admin = await User.find_one({"access_id": access_id})
-    if not admin or not admin.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    admin = await get_admin(access_id)
     
     user = await User.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    await user.delete()
+    # Delete the user and their votes in the background
+    await enqueue_job("delete_user", user_id=user_id)
     
     return RedirectResponse(
         url=f"/admin/{access_id}/users",
@@ -432,20 +505,90 @@ async def admin_delete_user(access_id: str, user_id: str):
 @app.post("/admin/{access_id}/experiments/{experiment_id}/delete")
 async def admin_delete_experiment(access_id: str, experiment_id: str):
     # Verify admin access
-    user = await User.find_one({"access_id": access_id})
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=404, detail="Not found")
+    user = await get_admin(access_id)
     
     # Get and verify experiment exists
     experiment = await Experiment.get(experiment_id)
     if not experiment:
         raise HTTPException(status_code=404, detail="Experiment not found")
     
-    # Delete the experiment
-    await experiment.delete()
+    # Delete the experiment and its access links in the background
+    await enqueue_job("delete_experiment", experiment_id=experiment_id)
     
     # Redirect back to dashboard
     return RedirectResponse(
         url=f"/admin/{access_id}",
         status_code=303
-    ) 
\ No newline at end of file
+    )
+
+@app.post("/admin/{access_id}/experiments/{experiment_id}/export/votes")
+async def admin_export_votes(access_id: str, experiment_id: str):
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    await enqueue_job("export_votes", experiment_id=experiment_id)
+    
+    return RedirectResponse(
+        url=f"/admin/{access_id}/jobs",
+        status_code=303
+    )
+
+@app.post("/admin/{access_id}/experiments/{experiment_id}/purge-votes")
+async def admin_purge_orphaned_votes(access_id: str, experiment_id: str):
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    await enqueue_job("purge_orphaned_votes", experiment_id=experiment_id)
+    
+    return RedirectResponse(
+        url=f"/admin/{access_id}/jobs",
+        status_code=303
+    )
+
+@app.get("/admin/{access_id}/jobs")
+async def admin_jobs(request: Request, access_id: str):
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    jobs = await Job.find_all().sort(-Job.created_at).limit(50).to_list()
+    has_active_jobs = any(job.status in ("pending", "running") for job in jobs)
+    
+    return templates.TemplateResponse(
+        "admin/jobs.html",
+        {"request": request, "jobs": jobs, "has_active_jobs": has_active_jobs, "access_id": access_id}
+    )
+
+@app.get("/admin/{access_id}/jobs/{job_id}")
+async def admin_job_status(access_id: str, job_id: str):
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    job = await Job.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/admin/{access_id}/jobs/{job_id}/download")
+async def admin_job_download(access_id: str, job_id: str):
+    # Verify admin access
+    user = await get_admin(access_id)
+    
+    job = await Job.get(job_id)
+    if not job or "file_id" not in job.result:
+        raise HTTPException(status_code=404, detail="Export not found")
+    
+    try:
+        export = await open_export(job.result["file_id"])
+    except NoFile:
+        # Superseded by a newer export, or the experiment was deleted
+        raise HTTPException(status_code=404, detail="Export no longer available")
+    
+    async def chunks():
+        while chunk := await export.readchunk():
+            yield chunk
+    
+    return StreamingResponse(
+        chunks(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(job.result['filename'])}"}
+    )
@@ -1,9 +1,14 @@
 import uuid
 from beanie import Document
-from pydantic import EmailStr, BaseModel
-from typing import List, Optional, Dict
+from pydantic import EmailStr, BaseModel, Field
+from typing import Any, List, Optional, Dict, Tuple
+from pymongo import ReturnDocument
+from bson import ObjectId
+from datetime import datetime
 from app.config import get_settings
 
+# (item_id, previous option_id or None, new option_id)
+ChoiceChange = Tuple[str, Optional[str], str]
 
 
 class Choice(BaseModel):
@@ -84,26 +89,92 @@ class Experiment(Document):
         await experiment.insert()
         return experiment
 
-    async def record_choice(self, user_email: str, item_id: str, chosen_option_id: str) -> bool:
-        # Find the item
+    async def record_choice(self, user_email: str, item_id: str, chosen_option_id: str) -> Optional[ChoiceChange]:
+        """Record a user's choice for an item, replacing any earlier choice.
+
+        See `record_choice_by_id`; this also updates the loaded instance.
+        """
+        change = await self.record_choice_by_id(self.id, user_email, item_id, chosen_option_id)
+        if change is None:
+            return None
+
+        # Keep this instance in step with what was written
+        choice = Choice.from_user_input(user_email=user_email, option_id=chosen_option_id)
         for item in self.items:
             if item.item_id == item_id:
-                # Find the option by ID
-                chosen_option = item.get_option_by_id(chosen_option_id)
-                if not chosen_option:
-                    return False
-                    
-                # Remove previous choice if it exists
                 item.choices = [c for c in item.choices if c.user_email != user_email]
-                # Add new choice
-                item.choices.append(Choice.from_user_input(
-                    user_email=user_email,
-                    option_id=chosen_option.id  # Still store the text for backward compatibility
-                ))
-                await self.save()
-                return True
-        
-        return False  # Item not found
+                item.choices.append(choice)
+        return change
+
+    @classmethod
+    async def record_choice_by_id(
+        cls,
+        experiment_id: ObjectId,
+        user_email: str,
+        item_id: str,
+        chosen_option_id: str
+    ) -> Optional[ChoiceChange]:
+        """Record a user's choice for an item without loading the experiment.
+
+        The swap is a single atomic update of just that item's choices, so
+        concurrent votes and background cleanups don't overwrite each other,
+        and a vote can never re-create a deleted experiment. Returns the
+        change as (item_id, previous option, new option), or None if the
+        experiment, item or option doesn't exist.
+        """
+        choice = Choice.from_user_input(
+            user_email=user_email,
+            option_id=chosen_option_id
+        )
+        before = await cls.get_motor_collection().find_one_and_update(
+            {
+                "_id": experiment_id,
+                # Only matches if the item exists and offers this option
+                "items": {"$elemMatch": {"item_id": item_id, "options.id": chosen_option_id}}
+            },
+            [{"$set": {"items": {"$map": {
+                "input": "$items",
+                "as": "item",
+                "in": {"$cond": [
+                    {"$eq": ["$$item.item_id", {"$literal": item_id}]},
+                    {"$mergeObjects": ["$$item", {"choices": {"$concatArrays": [
+                        {"$filter": {
+                            "input": {"$ifNull": ["$$item.choices", []]},
+                            "as": "choice",
+                            "cond": {"$ne": ["$$choice.user_email", {"$literal": user_email}]}
+                        }},
+                        [{"$literal": choice.model_dump()}]
+                    ]}}]},
+                    "$$item"
+                ]}
+            }}}}],
+            projection={"items": {"$elemMatch": {"item_id": item_id}}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            return None
+        previous_option_id = next(
+            (c["option_id"] for c in before["items"][0].get("choices", []) if c["user_email"] == user_email),
+            None
+        )
+        return item_id, previous_option_id, chosen_option_id
+
+    @classmethod
+    async def answered_item_ids(cls, experiment_id: ObjectId, user_email: str) -> List[str]:
+        """Ids of the items a user has voted on, without loading the experiment"""
+        result = await cls.get_motor_collection().aggregate([
+            {"$match": {"_id": experiment_id}},
+            {"$project": {"answered": {"$map": {
+                "input": {"$filter": {
+                    "input": "$items",
+                    "as": "item",
+                    "cond": {"$in": [{"$literal": user_email}, {"$ifNull": ["$$item.choices.user_email", []]}]}
+                }},
+                "as": "item",
+                "in": "$$item.item_id"
+            }}}}
+        ]).to_list(length=1)
+        return result[0]["answered"] if result else []
 
     def get_unanswered_items(self, user_email: str) -> List[ClassificationItem]:
         """Get all items that haven't been answered by the user"""
@@ -166,6 +237,63 @@ class Experiment(Document):
                 }
         return None
 
+class ExperimentDefinition(BaseModel):
+    """An experiment's content without its choices, for rendering results"""
+    id: str
+    name: str
+    user_instructions: str
+    items: List[ClassificationItem]
+    categories: List[str] = []
+    category_descriptions: Dict[str, str] = {}
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "ExperimentDefinition":
+        """Build from a raw experiment document, leaving the choices behind"""
+        return cls(
+            id=str(doc["_id"]),
+            name=doc["name"],
+            user_instructions=doc["user_instructions"],
+            items=[
+                ClassificationItem(
+                    item_id=item["item_id"],
+                    content=item["content"],
+                    options=item["options"]
+                )
+                for item in doc["items"]
+            ],
+            categories=doc.get("categories", []),
+            category_descriptions=doc.get("category_descriptions", {})
+        )
+
+class CacheVersion(Document):
+    """Shared counter bumped whenever a worker invalidates a cache entry"""
+    version: int = 0
+
+    class Settings:
+        name = "cache_versions"
+
+class Job(Document):
+    """A long-running admin operation, executed by the background job runner"""
+    kind: str
+    params: Dict[str, Any] = {}
+    status: str = "pending"  # pending, running, completed or failed
+    progress: int = 0
+    total: int = 0
+    message: str = ""
+    result: Dict[str, Any] = {}
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+
+    class Settings:
+        name = "jobs"
+
+    @property
+    def progress_percentage(self) -> float:
+        return round((self.progress / self.total * 100) if self.total > 0 else 0, 1)
+
 class User(Document):
     email: EmailStr
     full_name: str
@@ -213,8 +341,12 @@ class User(Document):
     async def generate_experiment_link(self, experiment_id: str) -> str:
         """Generate a new access link for an experiment"""
         access_id = str(uuid.uuid4())
+        # Set just this link; a full save would upsert and could re-create a deleted user
+        await self.get_motor_collection().update_one(
+            {"_id": self.id},
+            {"$set": {f"experiment_links.{experiment_id}": access_id}}
+        )
         self.experiment_links[experiment_id] = access_id
-        await self.save()
         return access_id 
 
     async def get_experiment_links(self) -> List[dict]:
@@ -1,14 +1,24 @@
+import os
 import typer
 import asyncio
+import tempfile
+from contextlib import contextmanager
+from itertools import chain
+from pathlib import Path
+from typing import List, Optional
 from app.database import init_db
 from app.models import User
 from app.config import get_settings
+from app.datasets import (
+    iter_records, response_columns, column_category, pairwise_items,
+    dedupe, stratified_sample, write_ndjson, TemplateError
+)
 
 app = typer.Typer()
 
 @app.command()
 def create_admin(email: str, full_name: str):
-    """Create an admin user - this is the only CLI command we need to keep"""
+    """Create an admin user"""
     async def _create():
         await init_db()
         user = await User.create_user(
@@ -24,5 +34,70 @@ def create_admin(email: str, full_name: str):
     typer.echo(f"Email: {user.email}")
     typer.echo(f"Admin dashboard: {settings.base_url}/admin/{user.access_id}")
 
+@app.command()
+def build_experiment(
+    source: Path,
+    output: Path,
+    name: str = typer.Option(..., help="Experiment name"),
+    instructions: str = typer.Option(..., help="Instructions shown to voters"),
+    content_template: str = typer.Option("{question}", help="Item content, formatted with each source record's fields. Backslash escapes such as \\n are decoded"),
+    column: Optional[List[str]] = typer.Option(None, help="Response column to compare (repeatable). Defaults to every column ending in --suffix"),
+    suffix: str = typer.Option("_response", help="Suffix marking response columns; stripped to get category names"),
+    description: Optional[List[str]] = typer.Option(None, help="Category description as category=text (repeatable)"),
+    sample: Optional[int] = typer.Option(None, min=1, help="Stratified sample of this many items, spread across response pairs"),
+    seed: Optional[int] = typer.Option(None, help="Random seed for sampling")
+):
+    """Build an NDJSON experiment comparing every pair of response columns in an evaluation set.
+
+    The source may be a JSON array or NDJSON and is streamed record by record.
+    Duplicate items are dropped by content hash, which keeps about 80 bytes in
+    memory per unique item. The output is only written once every item has
+    been built, and can be uploaded from the admin dashboard.
+    """
+    content_template = content_template.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    with open(source) as f:
+        records = iter_records(f)
+        first = next(records, None)
+        if first is None:
+            raise typer.BadParameter(f"{source} contains no records")
+
+        columns = column or response_columns(first, suffix)
+        if len(columns) < 2:
+            raise typer.BadParameter(f"Need at least two response columns, found: {', '.join(columns) or 'none'}")
+
+        categories = [column_category(col, suffix) for col in columns]
+        category_descriptions = {cat: cat for cat in categories}
+        for entry in description or []:
+            category, _, text = entry.partition("=")
+            if category not in category_descriptions:
+                raise typer.BadParameter(f"Unknown category in description: {category}")
+            category_descriptions[category] = text
+
+        tagged_items = dedupe(pairwise_items(chain([first], records), columns, suffix, content_template))
+        try:
+            if sample is not None:
+                items = stratified_sample(tagged_items, sample, seed)
+            else:
+                items = (item for _, item in tagged_items)
+
+            with _replace_on_success(output) as out:
+                count = write_ndjson(out, items, name, instructions, category_descriptions)
+        except TemplateError as e:
+            raise typer.BadParameter(str(e), param_hint="'--content-template'")
+
+    typer.echo(f"Wrote {count} items comparing {', '.join(categories)} to {output}")
+
+@contextmanager
+def _replace_on_success(path: Path):
+    """Write to a temporary file next to `path` and move it into place only if no error occurs"""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 if __name__ == "__main__":
     app() 
\ No newline at end of file
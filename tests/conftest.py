@@ -0,0 +1,101 @@
+import os
+from types import SimpleNamespace
+import pytest
+from pymongo import ReturnDocument
+
+# app.config requires a connection string at import time; tests never connect
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+
+
+def _values(value, path):
+    """Every value at a dotted path, fanning out over arrays like Mongo does"""
+    for key in path.split("."):
+        if isinstance(value, list):
+            value = [v.get(key) for v in value if isinstance(v, dict)]
+            value = [x for v in value for x in (v if isinstance(v, list) else [v])]
+        else:
+            value = value.get(key) if isinstance(value, dict) else None
+    return value if isinstance(value, list) else [value]
+
+
+def _matches(doc, query):
+    for path, condition in query.items():
+        values = _values(doc, path)
+        if isinstance(condition, dict) and "$lt" in condition:
+            if not any(v is not None and v < condition["$lt"] for v in values):
+                return False
+        elif isinstance(condition, dict) and "$elemMatch" in condition:
+            if not any(isinstance(v, dict) and _matches(v, condition["$elemMatch"]) for v in values):
+                return False
+        elif condition not in values:
+            return False
+    return True
+
+
+class MemoryCollection:
+    """Just enough of a Motor collection for code that filters on plain values,
+    `$lt` and `$elemMatch` and updates with `$set`.
+
+    Aggregation-pipeline updates are recorded in `calls` but not applied.
+    """
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.calls = []
+
+    def _find(self, query, sort=None):
+        docs = [doc for doc in self.docs if _matches(doc, query)]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: doc[key], reverse=direction < 0)
+        return docs
+
+    @staticmethod
+    def _apply(doc, update):
+        if isinstance(update, dict):
+            doc.update(update.get("$set", {}))
+
+    @staticmethod
+    def _project(doc, projection):
+        if not projection:
+            return dict(doc)
+        projected = {"_id": doc["_id"]}
+        for key, spec in projection.items():
+            if isinstance(spec, dict) and "$elemMatch" in spec:
+                projected[key] = [v for v in doc.get(key, []) if _matches(v, spec["$elemMatch"])][:1]
+            elif spec:
+                projected[key] = doc.get(key)
+        return projected
+
+    async def find_one_and_update(self, query, update, sort=None, projection=None,
+                                  return_document=ReturnDocument.BEFORE, **kwargs):
+        self.calls.append(("find_one_and_update", query, update, kwargs))
+        docs = self._find(query, sort)
+        if not docs:
+            return None
+        before = self._project(docs[0], projection)
+        self._apply(docs[0], update)
+        return self._project(docs[0], projection) if return_document == ReturnDocument.AFTER else before
+
+    async def update_one(self, query, update, **kwargs):
+        self.calls.append(("update_one", query, update, kwargs))
+        docs = self._find(query)[:1]
+        for doc in docs:
+            self._apply(doc, update)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs))
+
+    async def update_many(self, query, update, **kwargs):
+        self.calls.append(("update_many", query, update, kwargs))
+        docs = self._find(query)
+        for doc in docs:
+            self._apply(doc, update)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs))
+
+
+@pytest.fixture
+def memory_collection(monkeypatch):
+    """Route a Document class's raw collection to an in-memory stub"""
+    def install(document_class, docs=()):
+        collection = MemoryCollection(docs)
+        monkeypatch.setattr(document_class, "get_motor_collection", staticmethod(lambda: collection))
+        return collection
+    return install
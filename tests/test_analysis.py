@@ -0,0 +1,111 @@
+import math
+import random
+import numpy as np
+from app.analysis import ExperimentVotes, luce_choice_model
+
+
+def make_document(categories, items):
+    """Build a raw experiment document from (option categories, chosen indexes) pairs"""
+    doc_items = []
+    for i, (option_categories, chosen) in enumerate(items):
+        options = [
+            {"id": f"{i}_{j}", "text": "", "category": category}
+            for j, category in enumerate(option_categories)
+        ]
+        choices = [
+            {"user_email": f"user{u}@example.com", "option_id": f"{i}_{j}"}
+            for u, j in enumerate(chosen)
+        ]
+        doc_items.append({"item_id": str(i), "content": "", "options": options, "choices": choices})
+    return {"categories": categories, "items": doc_items}
+
+
+def test_counts_from_document():
+    doc = make_document(["A", "B"], [(["A", "B"], [0, 0, 1]), (["B", "A"], [1])])
+    doc["items"][1]["choices"].append({"user_email": "x@example.com", "option_id": "missing"})
+    tally = ExperimentVotes.from_document(doc)
+
+    assert len(tally) == 4
+    assert tally.votes_per_category() == {"A": 3, "B": 1}
+    assert tally.votes_per_item() == {"0": 3, "1": 1}
+    assert tally.votes_per_option() == {"0_0": 2, "0_1": 1, "1_0": 0, "1_1": 1}
+    assert not tally.is_multi_arm
+
+
+def test_option_counts_override():
+    doc = make_document(["A", "B", "C"], [(["A", "B", "C"], [0, 2]), (["C", "A"], [0])])
+    tally = ExperimentVotes.from_document(doc)
+    counts = tally.option_counts()
+    assert tally.votes_per_category(counts) == tally.votes_per_category()
+
+    # Move the first vote on item 0 from A to B, as the live feed would
+    counts[0] -= 1
+    counts[1] += 1
+    assert tally.votes_per_category(counts) == {"A": 0, "B": 1, "C": 2}
+    (offered, votes), = [group for group in tally.choice_sets(counts) if group[0].shape[1] == 3]
+    assert votes.tolist() == [[0, 1, 1]]
+
+
+def test_two_options_match_bradley_terry():
+    # With k=2 the MLE rating gap is the log odds of the observed wins
+    doc = make_document(["A", "B"], [(["A", "B"], [0] * 30 + [1] * 10)])
+    tally = ExperimentVotes.from_document(doc)
+    results = luce_choice_model(tally.choice_sets(), tally.categories, regularization=1e-6, seed=0)
+
+    gap = results[0]["rating"] - results[1]["rating"]
+    assert math.isclose(gap, math.log(3), rel_tol=1e-3)
+    assert results[0]["chosen"] == 30 and results[0]["offered"] == 40
+
+
+def test_recovers_simulated_strengths():
+    rng = random.Random(0)
+    categories = [f"m{i}" for i in range(8)]
+    true_rating = {c: 0.3 * i for i, c in enumerate(categories)}
+    items = []
+    for _ in range(3000):
+        offered = rng.sample(categories, rng.choice([2, 3, 5]))
+        weights = [math.exp(true_rating[c]) for c in offered]
+        items.append((offered, rng.choices(range(len(offered)), weights, k=5)))
+    tally = ExperimentVotes.from_document(make_document(categories, items))
+    assert tally.is_multi_arm
+
+    results = luce_choice_model(tally.choice_sets(), categories, seed=0)
+    expected = np.array([true_rating[c] for c in categories])
+    expected -= expected.mean()
+    fitted = np.array([r["rating"] for r in results])
+    std_error = np.array([r["std_error"] for r in results])
+
+    assert np.all(np.abs(fitted - expected) < 4 * std_error)
+    assert max(results, key=lambda r: r["prob_being_best"])["category"] == "m7"
+
+
+def test_unknown_categories_are_left_out_of_choice_sets():
+    doc = make_document(["A", "B"], [(["A", "B", "Z"], [0, 2, 2])])
+    tally = ExperimentVotes.from_document(doc)
+    (offered, votes), = tally.choice_sets()
+
+    assert offered.tolist() == [[0, 1]]
+    assert votes.tolist() == [[1, 0]]
+
+
+def test_no_categories_is_not_multi_arm():
+    doc = make_document([], [(["A", "B", "C"], [0, 1])])
+    tally = ExperimentVotes.from_document(doc)
+
+    assert not tally.is_multi_arm
+    assert luce_choice_model(tally.choice_sets(), tally.categories) == []
+
+
+def test_unoffered_categories_are_unrated():
+    # C is declared but never offered; A beats B 400-100
+    doc = make_document(["A", "B", "C"], [(["A", "B"], [0] * 400 + [1] * 100)])
+    tally = ExperimentVotes.from_document(doc)
+    assert not tally.is_multi_arm
+
+    a, b, c = luce_choice_model(tally.choice_sets(), tally.categories, regularization=1e-6, seed=0)
+    assert c["rating"] is None and c["win_share"] is None and c["prob_being_best"] is None
+    assert c["chosen"] == 0 and c["offered"] == 0
+    assert math.isclose(a["rating"] - b["rating"], math.log(4), rel_tol=1e-3)
+    assert a["std_error"] < 0.1
+    assert a["prob_being_best"] + b["prob_being_best"] == 1.0
+    assert math.isclose(a["win_share"], 0.8, rel_tol=1e-3)
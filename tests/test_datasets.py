@@ -0,0 +1,108 @@
+import io
+import json
+from collections import Counter
+from pathlib import Path
+import pytest
+from app import datasets
+from app.datasets import (
+    iter_records, pairwise_items, dedupe, stratified_sample, write_ndjson,
+    parse_experiment_upload, TemplateError, TemplateFieldError
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+
+RECORDS = [
+    {"question": "Is \"this\" split?", "a_response": "yes, [1, 2]", "b_response": "no {}"},
+    {"question": "unicode é€", "a_response": "x" * 50, "b_response": ""},
+    {"question": "last", "a_response": "]", "b_response": "["}
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 1 << 16])
+def test_iter_records_across_chunk_boundaries(monkeypatch, chunk_size):
+    monkeypatch.setattr(datasets, "CHUNK_SIZE", chunk_size)
+    array = "  [\n" + ",\n  ".join(json.dumps(r) for r in RECORDS) + "\n]\n"
+    ndjson = "".join(json.dumps(r) + "\n" for r in RECORDS) + "\n"
+
+    assert list(iter_records(io.StringIO(array))) == RECORDS
+    assert list(iter_records(io.StringIO(ndjson))) == RECORDS
+    assert list(iter_records(io.StringIO("[]"))) == []
+    assert list(iter_records(io.StringIO("   \n"))) == []
+
+
+def test_reproduces_policygpt_experiment():
+    expected = json.loads((ROOT / "policygpt_experiment.json").read_text())
+    with open(ROOT / "evaluation_set_with_all_responses.json") as f:
+        tagged_items = pairwise_items(
+            iter_records(f),
+            ["pinecone_response", "custom_response"],
+            "_response",
+            "## Question\n[Policy #{policy_number}]({policy_url})\n\n{question}"
+        )
+        items = [item for _, item in dedupe(tagged_items)]
+
+    assert items == expected["items"]
+
+
+def test_missing_template_field_names_record():
+    records = [{"question": "q", "a_response": "x", "b_response": "y"}, {"a_response": "x", "b_response": "y"}]
+    with pytest.raises(TemplateFieldError) as excinfo:
+        list(pairwise_items(records, ["a_response", "b_response"], "_response", "{question}"))
+    assert excinfo.value.field == "question"
+    assert excinfo.value.record_number == 2
+
+
+@pytest.mark.parametrize("template", ["{question", "{0}", "{question[99]}", "{question:d}"])
+def test_malformed_template_names_record(template):
+    records = [{"question": "q", "a_response": "x", "b_response": "y"}]
+    with pytest.raises(TemplateError) as excinfo:
+        list(pairwise_items(records, ["a_response", "b_response"], "_response", template))
+    assert excinfo.value.record_number == 1
+
+
+def test_pairwise_items_skip_empty_responses():
+    tagged_items = list(pairwise_items(RECORDS, ["a_response", "b_response"], "_response", "{question}"))
+    assert [stratum for stratum, _ in tagged_items] == [("a", "b"), ("a", "b")]
+
+
+def test_dedupe_ignores_option_order():
+    item = {"content": "q", "options": [{"text": "x", "category": "a"}, {"text": "y", "category": "b"}]}
+    swapped = {"content": "q", "options": item["options"][::-1]}
+    other = {"content": "q2", "options": item["options"]}
+    tagged_items = [(("a", "b"), item), (("b", "a"), swapped), (("a", "b"), other), (("a", "b"), item)]
+
+    assert [i for _, i in dedupe(tagged_items)] == [item, other]
+
+
+def test_stratified_sample_spreads_across_pairs():
+    tagged_items = [
+        (pair, {"pair": pair, "n": n})
+        for pair, size in [(("a", "b"), 100), (("a", "c"), 100), (("b", "c"), 2)]
+        for n in range(size)
+    ]
+
+    sample = stratified_sample(tagged_items, 20, seed=0)
+    counts = Counter(item["pair"] for item in sample)
+    assert len(sample) == 20
+    # The small pair gives its unused share to the others
+    assert counts == {("a", "b"): 9, ("a", "c"): 9, ("b", "c"): 2}
+    assert len({(item["pair"], item["n"]) for item in sample}) == 20
+
+    assert stratified_sample(tagged_items, 20, seed=0) == sample
+    assert len(stratified_sample(tagged_items, 1000, seed=0)) == 202
+
+
+def test_ndjson_round_trip():
+    items = [
+        {"content": "q", "options": [{"text": "x", "category": "a"}, {"text": "y", "category": "b"}]}
+    ] * 3
+    out = io.StringIO()
+    count = write_ndjson(out, items, "Name", "Pick one", {"a": "A", "b": "B"})
+
+    assert count == 3
+    assert parse_experiment_upload(out.getvalue().encode()) == {
+        "name": "Name",
+        "instructions": "Pick one",
+        "category_descriptions": {"a": "A", "b": "B"},
+        "items": items
+    }
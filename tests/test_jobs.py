@@ -0,0 +1,119 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from bson import ObjectId
+from app import jobs
+from app.models import Job
+
+
+@pytest.fixture
+def job_queue(monkeypatch, memory_collection):
+    monkeypatch.setattr(jobs.settings, "job_poll_interval", 0.01)
+    monkeypatch.setattr(jobs.settings, "job_stale_after", 30.0)
+    collection = memory_collection(Job)
+
+    def add(kind, status="pending", **fields):
+        doc = {
+            "_id": ObjectId(),
+            "kind": kind,
+            "params": fields.pop("params", {}),
+            "status": status,
+            "created_at": datetime.utcnow(),
+            **fields
+        }
+        collection.docs.append(doc)
+        return doc
+
+    collection.add = add
+    return collection
+
+
+def register(monkeypatch, kind, handler):
+    monkeypatch.setitem(jobs._handlers, kind, handler)
+
+
+def run_until_done(docs, concurrency, timeout=5.0):
+    """Run a fresh JobRunner until every job in `docs` has finished"""
+    async def main():
+        runner = jobs.JobRunner(concurrency=concurrency)
+        runner.start()
+        try:
+            deadline = asyncio.get_running_loop().time() + timeout
+            while any(doc["status"] in ("pending", "running") for doc in docs):
+                assert asyncio.get_running_loop().time() < deadline, "jobs did not finish"
+                await asyncio.sleep(0.01)
+        finally:
+            await runner.stop()
+    asyncio.run(main())
+
+
+def test_runs_jobs_in_order_and_stores_results(monkeypatch, job_queue):
+    seen = []
+
+    async def record(ctx, n):
+        await ctx.progress(1, 1, "Done")
+        seen.append(n)
+        return {"n": n}
+
+    register(monkeypatch, "record", record)
+    docs = [job_queue.add("record", params={"n": n}) for n in range(3)]
+    run_until_done(docs, concurrency=1)
+
+    assert seen == [0, 1, 2]
+    for n, doc in enumerate(docs):
+        assert doc["status"] == "completed"
+        assert doc["result"] == {"n": n}
+        assert doc["progress"] == 1 and doc["message"] == "Done"
+        assert doc["finished_at"] >= doc["started_at"]
+
+
+def test_respects_concurrency_limit(monkeypatch, job_queue):
+    active = 0
+    peak = 0
+
+    async def slow(ctx):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+
+    register(monkeypatch, "slow", slow)
+    docs = [job_queue.add("slow") for _ in range(6)]
+    run_until_done(docs, concurrency=2)
+
+    assert peak == 2
+    assert all(doc["status"] == "completed" and doc["result"] == {} for doc in docs)
+
+
+def test_failures_are_recorded_and_do_not_stop_the_runner(monkeypatch, job_queue):
+    async def boom(ctx):
+        raise RuntimeError("boom")
+
+    async def fine(ctx):
+        return {"ok": True}
+
+    register(monkeypatch, "boom", boom)
+    register(monkeypatch, "fine", fine)
+    failed = job_queue.add("boom")
+    unknown = job_queue.add("no_such_kind")
+    after = job_queue.add("fine")
+    run_until_done([failed, unknown, after], concurrency=1)
+
+    assert failed["status"] == "failed" and failed["error"] == "boom"
+    assert unknown["status"] == "failed" and "Unknown job kind" in unknown["error"]
+    assert after["status"] == "completed" and after["result"] == {"ok": True}
+
+
+def test_requeues_jobs_with_a_stale_heartbeat(monkeypatch, job_queue):
+    async def fine(ctx):
+        return {"ok": True}
+
+    register(monkeypatch, "fine", fine)
+    stale = job_queue.add("fine", status="running", heartbeat_at=datetime.utcnow() - timedelta(hours=1))
+    alive = job_queue.add("fine", status="running", heartbeat_at=datetime.utcnow())
+    run_until_done([stale], concurrency=1)
+
+    assert stale["status"] == "completed"
+    # Still heartbeating in another worker, so left alone
+    assert alive["status"] == "running"
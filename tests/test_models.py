@@ -0,0 +1,54 @@
+import asyncio
+from bson import ObjectId
+from app.models import Experiment
+
+EXPERIMENT_ID = ObjectId()
+
+
+def make_experiment(choices):
+    return {
+        "_id": EXPERIMENT_ID,
+        "items": [
+            {"item_id": "0", "options": [{"id": "a"}, {"id": "b"}], "choices": []},
+            {"item_id": "1", "options": [{"id": "c"}, {"id": "d"}], "choices": choices}
+        ]
+    }
+
+
+def test_record_choice_returns_the_change(memory_collection):
+    experiments = memory_collection(Experiment, [make_experiment([
+        {"user_email": "other@example.com", "option_id": "d"},
+        {"user_email": "voter@example.com", "option_id": "c"}
+    ])])
+
+    change = asyncio.run(Experiment.record_choice_by_id(EXPERIMENT_ID, "voter@example.com", "1", "d"))
+    assert change == ("1", "c", "d")
+
+    change = asyncio.run(Experiment.record_choice_by_id(EXPERIMENT_ID, "new@example.com", "1", "c"))
+    assert change == ("1", None, "c")
+
+    # A single conditional update: never an upsert, never a full-document write
+    assert all(call[0] == "find_one_and_update" for call in experiments.calls)
+    assert not any(call[3].get("upsert") for call in experiments.calls)
+
+
+def test_record_choice_rejects_unknown_item_or_option(memory_collection):
+    experiments = memory_collection(Experiment, [make_experiment([])])
+
+    assert asyncio.run(Experiment.record_choice_by_id(EXPERIMENT_ID, "voter@example.com", "1", "a")) is None
+    assert asyncio.run(Experiment.record_choice_by_id(EXPERIMENT_ID, "voter@example.com", "9", "a")) is None
+    assert asyncio.run(Experiment.record_choice_by_id(ObjectId(), "voter@example.com", "0", "a")) is None
+    assert len(experiments.calls) == 3
+
+
+def test_record_choice_keeps_user_input_literal(memory_collection):
+    experiments = memory_collection(Experiment, [make_experiment([])])
+    experiments.docs[0]["items"].append({"item_id": "$items", "options": [{"id": "$$ROOT"}], "choices": []})
+
+    asyncio.run(Experiment.record_choice_by_id(EXPERIMENT_ID, "voter@example.com", "$items", "$$ROOT"))
+    (_, _, pipeline, _), = experiments.calls
+    # Field paths and variables in ids must not be evaluated by the pipeline
+    item_in = pipeline[0]["$set"]["items"]["$map"]["in"]["$cond"]
+    assert item_in[0] == {"$eq": ["$$item.item_id", {"$literal": "$items"}]}
+    new_choice = item_in[1]["$mergeObjects"][1]["choices"]["$concatArrays"][1]
+    assert new_choice == [{"$literal": {"user_email": "voter@example.com", "option_id": "$$ROOT"}}]